@@ -1,19 +1,192 @@
 import streamlit as st
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
 import requests
+import asyncio
+import aiohttp
+import duckdb
+import functools
+import hashlib
+import os
+import threading
+import time
+import reprlib
 from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
-@st.cache_data
-def get_access_token(client_id: str, client_secret: str) -> str|None:
+# Versión de la API de Spotify: forma parte de la clave de las cachés de disco,
+# de modo que al cambiarla se descartan las respuestas guardadas con la anterior
+SPOTIFY_API_VERSION = 'v1'
+# Los tokens de Spotify caducan a la hora de emitirse: se guardan algo menos para no usarlos caducados
+TOKEN_TTL = timedelta(minutes=55)
+ARTIST_TTL = timedelta(days=7)
+# Directorio de las cachés propias del dashboard, configurable mediante variable de entorno
+CACHE_DIR = Path(os.environ.get('SPOTIFY_DASHBOARD_CACHE_DIR', Path.home() / '.cache' / 'spotify_dashboard'))
+# Número máximo de llamadas distintas de las que se guardan estadísticas en cada sesión
+MAX_CACHE_STATS_ENTRIES = 50
+# Reintentos ante respuestas 429 (demasiadas peticiones) de la API
+MAX_RETRIES = 3
+# Espera máxima entre reintentos, en segundos: si la API pide esperar más, se desiste
+MAX_RETRY_WAIT = 10
+# Directorio donde se guardan en Parquet los historiales ya procesados
+HISTORY_CACHE_DIR = CACHE_DIR / 'history'
+# Los historiales guardados se borran si no se usan en este tiempo, o si ocupan demasiado
+HISTORY_MAX_AGE = timedelta(days=7)
+HISTORY_MAX_BYTES = 200 * 1024**2
+# Versión del preprocesado del historial: forma parte del nombre de los ficheros de la caché,
+# por lo que debe incrementarse cada vez que cambie load_history_file
+HISTORY_FORMAT_VERSION = 1
+
+class AuthError(Exception):
+    """ Spotify no ha proporcionado un token de acceso con las credenciales indicadas """
+
+class RateLimitError(Exception):
+    """ La API de Spotify sigue limitando las peticiones tras agotar los reintentos """
+
+class ArtistSearchError(Exception):
+    """ Alguna de las búsquedas de un lote de artistas ha fallado
+
+    Atributos:
+        results: Datos de los artistas que sí se han obtenido, indexados por nombre
+        errors: Excepción producida en la búsqueda de cada artista que ha fallado
+    """
+    def __init__(self, results: dict[str, dict], errors: dict[str, Exception]):
+        super().__init__(f'Fallo al buscar {len(errors)} artistas: {", ".join(errors)}')
+        self.results = results
+        self.errors = errors
+
+def cache_period(ttl: timedelta) -> int:
+    """ Obtiene el periodo de validez actual de una caché con la duración indicada
+
+    Las cachés persistentes en disco de Streamlit no admiten ttl, por lo que el
+    periodo se pasa como argumento a las funciones cacheadas: al cambiar de periodo
+    cambia la clave y las entradas anteriores dejan de utilizarse
+    
+    Argumentos:
+        ttl: Duración máxima de una entrada de la caché
+    Devuelve:
+        Entero que identifica el periodo actual
+    """
+    return int(datetime.now(timezone.utc).timestamp() // ttl.total_seconds())
+
+def current_cache_period(cached_fn, ttl: timedelta) -> int:
+    """ Obtiene el periodo de validez actual de una función cacheada en disco, y vacía
+        su caché cuando el periodo cambia
+
+    Streamlit no elimina nunca las entradas persistidas en disco, así que las de periodos
+    anteriores se borran al cambiar de periodo. El último periodo se guarda en CACHE_DIR
+    para detectar el cambio también después de reiniciar la aplicación
+    
+    Argumentos:
+        cached_fn: Función decorada con st.cache_data(persist='disk')
+        ttl: Duración máxima de una entrada de la caché
+    Devuelve:
+        Entero que identifica el periodo actual
+    """
+    period = cache_period(ttl)
+    marker = CACHE_DIR / f'{cached_fn.__name__}.period'
+    if not marker.exists() or marker.read_text() != str(period):
+        cached_fn.clear()
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        marker.write_text(str(period))
+
+    return period
+
+def get_cache_stats() -> dict[str, Counter]:
+    """ Obtiene los contadores de llamadas y fallos de las funciones cacheadas
+
+    Se guardan en la sesión, de modo que cada usuario sólo ve sus propias llamadas
+    """
+    return st.session_state.setdefault('cache_stats', {})
+
+def _call_stats(key: str) -> Counter:
+    """ Obtiene los contadores de una llamada, conservando sólo las más recientes
+
+    Argumentos:
+        key: Clave de la llamada, obtenida con _call_key
+    Devuelve:
+        Contador con las llamadas, fallos y duración del fallo más lento
+    """
+    stats = get_cache_stats()
+    # Al reinsertar la clave queda al final, y se descartan primero las usadas hace más tiempo
+    call_stats = stats.pop(key, None)
+    stats[key] = call_stats if call_stats is not None else Counter()
+    while len(stats) > MAX_CACHE_STATS_ENTRIES:
+        del stats[next(iter(stats))]
+
+    return stats[key]
+
+def _call_key(fn_name: str, args: tuple, kwargs: dict, redact: bool) -> str:
+    """ Construye la clave con la que se registran las estadísticas de una llamada
+
+    Argumentos:
+        fn_name: Nombre de la función cacheada
+        args: Argumentos posicionales de la llamada
+        kwargs: Argumentos por nombre de la llamada
+        redact: Si es True, los argumentos se sustituyen por un hash corto para no mostrarlos
+    Devuelve:
+        String con el nombre de la función y una representación abreviada de sus argumentos
+    """
+    if redact:
+        call_args = '#' + hashlib.blake2b(repr((args, kwargs)).encode(), digest_size=4).hexdigest()
+    else:
+        call_args = reprlib.repr((args, kwargs) if kwargs else args)
+    return f'{fn_name}{call_args}'
+
+def tracked(cache_decorator, redact: bool = False):
+    """ Aplica un decorador de caché de Streamlit registrando sus estadísticas de uso
+
+    Para cada combinación de argumentos se cuentan las llamadas y las veces que la
+    función se ejecuta realmente (fallos de caché), junto con la duración del fallo
+    más lento, en milisegundos. Así se distinguen las llamadas que se repiten
+    
+    Argumentos:
+        cache_decorator: Decorador de caché, como st.cache_data(persist='disk')
+        redact: Si es True, no se muestran los argumentos (por ejemplo, credenciales)
+    Devuelve:
+        Decorador que aplica la caché y registra las estadísticas
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def miss(*args, **kwargs):
+            stats = _call_stats(_call_key(fn.__name__, args, kwargs, redact))
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                # Los fallos que lanzan excepciones (reintentos agotados, timeouts) también cuentan
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                stats['misses'] += 1
+                stats['slowest_miss_ms'] = max(stats['slowest_miss_ms'], elapsed_ms)
+        cached_fn = cache_decorator(miss)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            _call_stats(_call_key(fn.__name__, args, kwargs, redact))['calls'] += 1
+            return cached_fn(*args, **kwargs)
+        wrapper.clear = cached_fn.clear
+        return wrapper
+    return decorator
+
+# El token sólo se guarda en memoria: así las credenciales nunca se escriben en disco
+@tracked(st.cache_data(ttl=TOKEN_TTL, max_entries=100), redact=True)
+def get_access_token(client_id: str, client_secret: str) -> str:
     """ Obtiene el token de acceso a partir del ID de cliente y su clave secreta
         para obtener acceso a la funcionalidad "no de usuario" de Spotify
+
+    Los fallos se notifican con excepciones, de modo que no se guardan en la caché
     
     Argumentos:
         client_id: String con el ID de cliente
         client_secret: String con el secreto de cliente
     Devuelve:
-        String con el token de acceso, o None si el servidor no lo proporciona
+        String con el token de acceso
+    Lanza:
+        AuthError si las credenciales son incorrectas o la respuesta no incluye el token
+        requests.RequestException si falla la conexión o el servidor responde con un error
     """
 
     # Endpoint: https://accounts.spotify.com/api/token
@@ -21,8 +194,15 @@ def get_access_token(client_id: str, client_secret: str) -> str|None:
                              headers={'Content-Type':'application/x-www-form-urlencoded'},
                              data=dict(grant_type='client_credentials', 
                                        client_id=client_id, 
-                                       client_secret=client_secret))
+                                       client_secret=client_secret),
+                             timeout=10)
+    # Spotify responde 400 (invalid_client) o 401 si las credenciales no son válidas
+    if response.status_code in (400, 401):
+        raise AuthError(response.text)
+    response.raise_for_status()
     access_token = response.json().get('access_token', None)
+    if not access_token:
+        raise AuthError('La respuesta no incluye el token de acceso')
     
     return access_token
 
@@ -37,54 +217,396 @@ def load_history_file(file) -> pd.DataFrame:
     print(type(file))
     print(file)
     # Carga del fichero en un dataframe
-    rep_data = pd.read_json(file)
+    # El historial es una lista de registros: se indican orientación y tipos para evitar inferirlos
+    rep_data = pd.read_json(file, orient='records', convert_dates=False,
+                            dtype={'endTime': str, 'artistName': str, 'trackName': str, 'msPlayed': 'int32'})
+    # Los nombres se repiten mucho: como categorías, las agrupaciones trabajan sobre códigos enteros
+    rep_data[['artistName', 'trackName']] = rep_data[['artistName', 'trackName']].astype('category')
     # Se eliminan registros duplicados: canciones que figuran dos veces, terminando a la vez,
     # pero con duraciones de reproducción diferentes.
     # Identificamos todos los registros duplicados
-    min_duracion = rep_data[rep_data.duplicated(subset=['endTime', 'artistName', 'trackName'], keep=False)]
-    # Para cada duplicado, obtenemos el índice del de menor duración
-    min_duracion = min_duracion.groupby(['artistName', 'trackName', 'endTime']).idxmin()
-    # Descartamos los registros cuyo índice es uno de los registros en min_duracion
-    rep_data = rep_data[~rep_data.msPlayed.isin(min_duracion.msPlayed)]
-    rep_data = rep_data.reset_index(drop=True)
-
-    # Agregamos una columna con la fecha de reproducción
-    rep_data['playDate'] = pd.to_datetime(rep_data.endTime, format='ISO8601').values
+    dup_mask = rep_data.duplicated(subset=['endTime', 'artistName', 'trackName'], keep=False)
+    # Para cada duplicado, obtenemos el índice del de mayor duración, que es el que se conserva
+    keep_idx = rep_data[dup_mask].groupby(['artistName', 'trackName', 'endTime'], sort=False, observed=True)['msPlayed'].idxmax()
+    # Descartamos por índice el resto de registros duplicados
+    drop_idx = rep_data.index[dup_mask].difference(keep_idx)
+    rep_data = rep_data.drop(drop_idx).reset_index(drop=True)
+
+    # Agregamos una columna con la fecha de reproducción (endTime tiene el formato "YYYY-MM-DD HH:MM")
+    rep_data['playDate'] = pd.to_datetime(rep_data['endTime'].to_numpy(), format='%Y-%m-%d %H:%M', cache=True)
     # Agregamos una columna con el tiempo de reproducción, en minutos
-    rep_data['minPlayed'] = rep_data.msPlayed//60000
+    rep_data['minPlayed'] = (rep_data['msPlayed'].to_numpy() // 60000).astype('int32')
 
     return rep_data
 
+def prune_history_cache():
+    """ Elimina de la caché los historiales de versiones anteriores del preprocesado,
+        los que no se han usado en HISTORY_MAX_AGE y, empezando por los usados hace
+        más tiempo, los que exceden HISTORY_MAX_BYTES en total
+    """
+    if not HISTORY_CACHE_DIR.exists():
+        return
+
+    now = time.time()
+    kept = []
+    for path in HISTORY_CACHE_DIR.glob('*.parquet'):
+        try:
+            stat = path.stat()
+            if not path.name.endswith(f'.v{HISTORY_FORMAT_VERSION}.parquet') \
+                    or now - stat.st_mtime > HISTORY_MAX_AGE.total_seconds():
+                path.unlink()
+            else:
+                kept.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError: # Otra sesión lo ha borrado a la vez
+            pass
+
+    total_bytes = sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if total_bytes <= HISTORY_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+
+def load_history_cached(file, digest: str) -> pd.DataFrame:
+    """ Carga el historial preprocesado desde la caché en disco, o lo procesa y lo guarda
+
+    La caché se guarda en Parquet, que conserva los tipos de las columnas (incluidas 
+    las categóricas) y se lee más rápido que un pickle del dataframe
+    
+    Argumentos:
+        file: Fichero o ruta del fichero JSON que contiene los datos
+        digest: Hash del contenido del fichero, que junto a HISTORY_FORMAT_VERSION
+                identifica la entrada de la caché
+    Devuelve:
+        Dataframe con los datos preprocesados
+    """
+    prune_history_cache()
+    path = HISTORY_CACHE_DIR / f'{digest}.v{HISTORY_FORMAT_VERSION}.parquet'
+    try:
+        # Se actualiza la fecha de modificación para que cuente como usado recientemente
+        os.utime(path)
+        return pd.read_parquet(path)
+    except FileNotFoundError: # No está en la caché, o se acaba de eliminar
+        pass
+
+    rep_data = load_history_file(file)
+    HISTORY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # Se escribe en un fichero temporal y se renombra, para no dejar nunca un fichero a medias
+    tmp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+    try:
+        rep_data.to_parquet(tmp_path, compression='zstd')
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return rep_data
+
+# Métricas por artista: los tres top 10 se devuelven juntos, etiquetados en la columna ranking,
+# y cada fila incluye además los totales de artistas y canciones distintas
+ARTIST_STATS_QUERY = """
+WITH agg AS (
+    SELECT artistName,
+           COUNT(*) AS plays,
+           SUM(msPlayed) AS total_ms,
+           COUNT(DISTINCT trackName) AS distinct_tracks
+    FROM h
+    GROUP BY artistName
+), stats AS (
+    SELECT *,
+           COUNT(*) OVER () AS n_artists,
+           SUM(distinct_tracks) OVER () AS n_songs
+    FROM agg
+)
+SELECT 'plays' AS ranking, ROW_NUMBER() OVER (ORDER BY plays DESC, artistName) AS pos, *
+FROM stats QUALIFY pos <= 10
+UNION ALL
+SELECT 'total_ms' AS ranking, ROW_NUMBER() OVER (ORDER BY total_ms DESC, artistName) AS pos, *
+FROM stats QUALIFY pos <= 10
+UNION ALL
+SELECT 'distinct_tracks' AS ranking, ROW_NUMBER() OVER (ORDER BY distinct_tracks DESC, artistName) AS pos, *
+FROM stats QUALIFY pos <= 10
+ORDER BY ranking, pos
+"""
+
+@st.cache_data(hash_funcs={pd.DataFrame: lambda df: int(pd.util.hash_pandas_object(df).sum())})
+def compute_artist_stats(data: pd.DataFrame) -> tuple[dict[str, pd.DataFrame], int, int]:
+    """ Calcula con DuckDB los artistas más escuchados según cada criterio
+    
+    Argumentos:
+        data: Dataframe con el historial de reproducciones preprocesado
+    Devuelve:
+        Diccionario con el top 10 de artistas por número de reproducciones ('plays'),
+        tiempo de escucha ('total_ms') y canciones distintas ('distinct_tracks'),
+        número de artistas distintos y número de canciones distintas
+    """
+    with duckdb.connect() as con:
+        con.register('h', data[['artistName', 'trackName', 'msPlayed']])
+        stats = con.execute(ARTIST_STATS_QUERY).df()
+
+    n_artists = int(stats['n_artists'].iloc[0])
+    n_songs = int(stats['n_songs'].iloc[0])
+    stats = stats.drop(columns=['pos', 'n_artists', 'n_songs'])
+    top_artists = {ranking: group.drop(columns='ranking').reset_index(drop=True)
+                   for ranking, group in stats.groupby('ranking', sort=False)}
+
+    return top_artists, n_artists, n_songs
+
 @st.cache_data
-def search_artist(artist_name: str) -> dict:
-    """ Obtiene el ID de un artista a partir de su nombre
+def _hist_pair(playdate_ns: np.ndarray, minplayed: np.ndarray, edges_ns: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Calcula a la vez los histogramas de reproducciones y de minutos escuchados
 
-    Como el endpoint de búsqueda devuelve una lista de resultados relevantes,
-    es necesario revisar los resultados para seleccionar el artista adecuado
+    El intervalo de cada reproducción se obtiene una única vez y se reutiliza para ambos
+    
+    Argumentos:
+        playdate_ns: Fechas de reproducción, en nanosegundos
+        minplayed: Minutos escuchados en cada reproducción
+        edges_ns: Límites de los intervalos, en nanosegundos
+    Devuelve:
+        Número de reproducciones y minutos escuchados en cada intervalo
+    """
+    bin_ix = np.searchsorted(edges_ns, playdate_ns, side='right') - 1
+    n_bins = len(edges_ns) - 1
+    counts = np.bincount(bin_ix, minlength=n_bins)
+    minutes = np.bincount(bin_ix, weights=minplayed, minlength=n_bins)
+
+    return counts, minutes
+
+def _select_artist(artist_name: str, response_json: dict) -> dict:
+    """ Selecciona el artista adecuado de entre los resultados de una búsqueda
+
+    Sólo se conservan los campos que utiliza el dashboard, para reducir el tamaño de la caché
     
     Argumentos:
         artist_name: Nombre del artista
+        response_json: Respuesta en JSON del endpoint de búsqueda
     Devuelve:
-        Diccionario con la respuesta en JSON del servidor
-    """
-    params = dict(q=f'artist:{artist_name}', 
-                  type=['artist'],
-                  market='ES',
-                  limit=50)
-    response = requests.get(url='https://api.spotify.com/v1/search', 
-                            headers=header, 
-                            params=params)
-    if 'artists' in response.json():
+        Diccionario con el nombre, la URL de la imagen (o None) y los géneros del artista.
+        Si no se encuentra, la imagen es None y la lista de géneros está vacía
+    """
+    art = {}
+    if 'artists' in response_json:
         # Recorremos la lista de artistas devueltos por la API
-        for art in response.json()['artists']['items']:
+        for item in response_json['artists']['items']:
             # Su nombre debe coincidir con el recibido como parámetro
-            if art['name'] == artist_name:
-                return art
-        else: # Si no se encuentra, se devuelve un diccionario vacío
-            return {}
-    else:
-        return {}
+            if item['name'] == artist_name:
+                art = item
+                break
+
+    return {'name': art.get('name', artist_name),
+            'image': art['images'][0]['url'] if art.get('images') else None,
+            'genres': art.get('genres', [])}
+
+def _search_params(artist_name: str) -> dict:
+    """ Construye los parámetros de búsqueda de un artista por su nombre """
+    return dict(q=f'artist:{artist_name}', 
+                type='artist',
+                market='ES',
+                limit=50)
+
+async def _search_artist_async(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, 
+                               rate_limited: asyncio.Event, artist_name: str, api_version: str) -> dict:
+    """ Obtiene los datos de un artista a partir de su nombre
+
+    Como el endpoint de búsqueda devuelve una lista de resultados relevantes,
+    es necesario revisar los resultados para seleccionar el artista adecuado.
+    Si la API limita las peticiones (HTTP 429), se reintenta la búsqueda esperando lo
+    indicado en la cabecera Retry-After, con un tiempo de espera creciente. Si la espera
+    pedida supera MAX_RETRY_WAIT, se desiste directamente
     
+    Argumentos:
+        session: Sesión HTTP compartida por todas las búsquedas
+        semaphore: Semáforo que limita las peticiones simultáneas a la API
+        rate_limited: Evento compartido que se activa si se agotan los reintentos,
+                      para que el resto de búsquedas no sigan insistiendo
+        artist_name: Nombre del artista
+        api_version: Versión de la API de Spotify
+    Devuelve:
+        Diccionario con el nombre, la imagen y los géneros del artista
+    Lanza:
+        RateLimitError si la API sigue limitando las peticiones tras MAX_RETRIES reintentos,
+        o si pide esperar más de MAX_RETRY_WAIT segundos
+        aiohttp.ClientResponseError si la API responde con cualquier otro error
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limited.is_set():
+            raise RateLimitError(artist_name)
+        async with semaphore:
+            async with session.get(url=f'https://api.spotify.com/{api_version}/search', 
+                                   params=_search_params(artist_name)) as response:
+                if response.status != 429:
+                    # Los errores del servidor no deben confundirse con un artista no encontrado
+                    response.raise_for_status()
+                    return _select_artist(artist_name, await response.json())
+                retry_after = response.headers.get('Retry-After', '')
+        if attempt < MAX_RETRIES:
+            backoff = 2**attempt
+            wait = max(int(retry_after), backoff) if retry_after.isdigit() else backoff
+            if wait > MAX_RETRY_WAIT:
+                break
+            # La espera se hace fuera del semáforo para no bloquear al resto de búsquedas
+            await asyncio.sleep(wait)
+
+    rate_limited.set()
+    raise RateLimitError(artist_name)
+
+async def _search_artists_gather(artist_names: tuple[str, ...], api_version: str) -> list[dict|BaseException]:
+    """ Lanza concurrentemente la búsqueda de todos los artistas indicados
+
+    Las búsquedas que fallan devuelven su excepción en lugar de cancelar el resto del lote
+    """
+    # Se limita el número de peticiones simultáneas para respetar los límites de la API
+    semaphore = asyncio.Semaphore(10)
+    rate_limited = asyncio.Event()
+    async with aiohttp.ClientSession(headers=header) as session:
+        return await asyncio.gather(*[_search_artist_async(session, semaphore, rate_limited, name, api_version) 
+                                      for name in artist_names], return_exceptions=True)
+
+@tracked(st.cache_data(persist='disk', max_entries=256))
+def search_artists_bulk(artist_names: tuple[str, ...], api_version: str, period: int) -> dict[str, dict]:
+    """ Obtiene los datos de varios artistas a partir de sus nombres
+
+    Las búsquedas se realizan de forma concurrente, de modo que el tiempo total
+    es similar al de una única petición
+    
+    Argumentos:
+        artist_names: Tupla ordenada con los nombres de los artistas
+        api_version: Versión de la API de Spotify
+        period: Periodo de validez de la caché (ver current_cache_period)
+    Devuelve:
+        Diccionario con el nombre, la imagen y los géneros de cada artista
+    Lanza:
+        ArtistSearchError si alguna búsqueda falla (por ejemplo, porque la API limita las
+        peticiones de forma persistente). La excepción incluye los artistas obtenidos, pero
+        no se guarda nada en la caché, de modo que sólo se repiten las búsquedas fallidas
+    """
+    results = asyncio.run(_search_artists_gather(artist_names, api_version))
+    artists, errors = {}, {}
+    for name, result in zip(artist_names, results):
+        if isinstance(result, Exception):
+            errors[name] = result
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            artists[name] = result
+    if errors:
+        raise ArtistSearchError(artists, errors)
+
+    return artists
+    
+def render_artist_card(rank: int, art: dict, subtitle: str):
+    """ Muestra la tarjeta de un artista: su imagen, posición y nombre, y un subtítulo
+
+    Argumentos:
+        rank: Posición del artista en el top
+        art: Datos del artista, obtenidos con search_artists_bulk
+        subtitle: Texto bajo el nombre del artista
+    """
+    with st.container():
+        cols = st.columns([0.4,1])
+        if art['image']:
+            cols[0].image(art['image'])
+        cols[1].markdown(f"#### {rank}. {art['name']}\n{subtitle}")
+
+def render_metrics(data: pd.DataFrame, n_artists: int, n_songs: int):
+    """ Muestra las métricas generales del historial de reproducciones
+
+    Argumentos:
+        data: Dataframe con el historial de reproducciones preprocesado
+        n_artists: Número de artistas distintos escuchados
+        n_songs: Número de canciones distintas escuchadas
+    """
+    st.metric(label='Período', value=f"{data.playDate.min().date()} > {data.playDate.max().date()}")
+    cols = st.columns([1,1,1,2])
+    cols[0].metric(label='Canciones escuchadas', value=n_songs)
+    cols[1].metric(label='Artistas escuchados',  value=n_artists)
+    cols[2].metric(label='Horas escuchadas',  value=f'{data.minPlayed.sum()/60:.1f}h')
+
+def render_top_songs(data: pd.DataFrame):
+    """ Muestra las canciones más escuchadas
+
+    Argumentos:
+        data: Dataframe con el historial de reproducciones preprocesado
+    """
+    with st.container(): # Canciones
+        st.markdown('# Canciones')
+
+        st.markdown('## Top 10 canciones')
+        # Orden ascendente para que la canción más escuchada aparezca arriba en el gráfico
+        top_songs = data.groupby(['artistName','trackName'], sort=False, observed=True).size()\
+                        .nlargest(10).iloc[::-1].reset_index(name='count')
+        top_songs['nombre_completo'] = top_songs['trackName'].astype(str) + ' - ' + top_songs['artistName'].astype(str)
+        st.plotly_chart(px.bar(top_songs, y='nombre_completo', x='count', orientation='h'))
+
+def render_top_artists(top_artists: dict[str, pd.DataFrame], artist_cache: dict[str, dict]):
+    """ Muestra los artistas más escuchados según cada criterio y sus géneros preferidos
+
+    Argumentos:
+        top_artists: Top 10 de artistas por criterio, obtenido con compute_artist_stats
+        artist_cache: Datos de Spotify de cada artista, indexados por nombre
+    """
+    with st.container(): # Artistas
+        st.markdown('# Top 10 Artistas')
+
+        top_artists_by_plays = top_artists['plays']
+        top_artists_by_time = top_artists['total_ms']
+        top_artists_by_distinct = top_artists['distinct_tracks']
+
+        st.markdown('## Por veces reproducido')
+        columns = st.columns(2)
+        for idx, row in top_artists_by_plays.iterrows():
+            with columns[idx//5]:
+                render_artist_card(idx+1, artist_cache[row.artistName], f"{row.plays} veces reproducido")
+        
+        st.markdown('---')
+        st.markdown('## Por tiempo de reproducción')
+        columns = st.columns(2)
+        for idx, row in top_artists_by_time.iterrows():
+            with columns[idx//5]:
+                render_artist_card(idx+1, artist_cache[row.artistName], f"{row.total_ms/60000:.0f} minutos de escucha")
+
+        st.markdown('---')
+        st.markdown('## Por canciones diferentes escuchadas')
+        columns = st.columns(2)
+        for idx, row in top_artists_by_distinct.iterrows():
+            with columns[idx//5]:
+                render_artist_card(idx+1, artist_cache[row.artistName], f"{row.distinct_tracks:.0f} canciones distintas")
+
+        st.markdown('---')
+        st.markdown('## Géneros preferidos')
+        st.markdown('De acuerdo a tus artistas preferidos, los géneros que más escuchas son:')
+        genres_series = pd.Series([artist_cache[name]['genres'] for name in top_artists_by_distinct.artistName])
+        top_genres = genres_series.explode().value_counts().head(5)
+        for k, v in top_genres.items():
+            st.markdown(f'- {k} ({v})')
+
+def render_usage_stats(data: pd.DataFrame):
+    """ Muestra la evolución del número de reproducciones y del tiempo de escucha
+
+    Argumentos:
+        data: Dataframe con el historial de reproducciones preprocesado
+    """
+    with st.container(): # Estadísticas de uso
+        # Los histogramas se agrupan aquí en intervalos de 2 días, de modo que al 
+        # navegador sólo se envían los totales de cada intervalo
+        bin_size = pd.Timedelta(days=2)
+        edges = pd.date_range(data.playDate.min().normalize(), data.playDate.max() + bin_size, freq=bin_size)
+        counts, minutes = _hist_pair(data.playDate.to_numpy().view('i8'), data.minPlayed.to_numpy(), edges.asi8)
+        bin_centers = edges[:-1] + bin_size/2
+
+        st.markdown('# Estadísticas de uso (canciones)')
+
+        graph = go.Figure(go.Bar(x=bin_centers, y=counts, width=bin_size.total_seconds()*1000))
+        graph.update_layout(bargap=0, xaxis_title='playDate', yaxis_title='count')
+        # graph.update_xaxes(showgrid=True, ticklabelmode="period", dtick="M1", tickformat="%b %Y")
+        st.plotly_chart(graph)
+
+        st.markdown('# Estadísticas de uso (tiempo)')
+        
+        graph = go.Figure(go.Bar(x=bin_centers, y=minutes, width=bin_size.total_seconds()*1000))
+        graph.update_layout(bargap=0, xaxis_title='playDate', yaxis_title='sum of minPlayed')
+        # graph.update_xaxes(showgrid=True, ticklabelmode="period", dtick="D1", tickformat="%b %Y")
+        st.plotly_chart(graph)
+
 client_id = None
 client_secret = None
 access_token = None
@@ -107,117 +629,59 @@ client_id = client_id_input
 client_secret = client_secret_input
 
 if client_id and client_secret:
-    access_token = get_access_token(client_id, client_secret)
+    auth_message = 'Credenciales incorrectas.'
+    try:
+        access_token = get_access_token(client_id, client_secret)
+    except AuthError:
+        pass
+    except requests.RequestException:
+        auth_message = 'No se ha podido conectar con Spotify. Inténtalo de nuevo más tarde.'
     if access_token:
         header = {'Content-Type':'application/json',
                   'Authorization': 'Bearer '+ access_token}
         if file_uploader:
-            data = load_history_file(file_uploader)
-
-            # Metrics
-            st.metric(label='Período', value=f"{data.playDate.min().date()} > {data.playDate.max().date()}")
-            cols = st.columns([1,1,1,2])
-            cols[0].metric(label='Canciones escuchadas', value=data.drop_duplicates(subset=['trackName', 'artistName']).shape[0])
-            cols[1].metric(label='Artistas escuchados',  value=data.drop_duplicates(subset=['artistName']).shape[0])
-            cols[2].metric(label='Horas escuchadas',  value=f'{data.minPlayed.sum()/60:.1f}h')
-
-            with st.container(): # Canciones
-                st.markdown('# Canciones')
-
-                st.markdown('## Top 10 canciones')
-                top_songs = data.groupby(['artistName','trackName']).count().sort_values('msPlayed', ascending=True).tail(10).reset_index()
-                top_songs['nombre_completo'] = top_songs['trackName'] + ' - ' + top_songs['artistName']
-                st.plotly_chart(px.bar(top_songs, y='nombre_completo', x='msPlayed', orientation='h'))
-            
-            with st.container(): # Artistas
-                st.markdown('# Top 10 Artistas')
-
-                st.markdown('## Por veces reproducido')
-                top_artists = data.groupby(['artistName']).count().sort_values('msPlayed', ascending=False).head(10).reset_index()
-                columns = st.columns(2)
-                with st.spinner():
-                    for idx, row in top_artists.iterrows():    
-                        with columns[idx//5]:
-                            art = search_artist(row.artistName)
-                            with st.container():
-                                cols = st.columns([0.4,1])
-                                try:
-                                    cols[0].image(art["images"][0]["url"])
-                                except IndexError:
-                                    pass 
-                                except KeyError: 
-                                    pass
-                                cols[1].markdown(f'#### {idx+1}. {art["name"]}')
-                                cols[1].markdown(f"{row.trackName} veces reproducido")
-                
-                st.markdown('---')
-                st.markdown('## Por tiempo de reproducción')
-                top_artists = data.drop('playDate', axis=1).groupby(['artistName']).sum().sort_values('msPlayed', ascending=False).head(10).reset_index()
-                columns = st.columns(2)
-                for idx, row in top_artists.iterrows():      
-                    with columns[idx//5]:          
-                        art = search_artist(row.artistName)
-                        with st.container():
-                            cols = st.columns([0.4,1])
-                            try:
-                                cols[0].image(art["images"][0]["url"])
-                            except IndexError:
-                                pass 
-                            except KeyError: 
-                                pass
-                            cols[1].markdown(f'#### {idx+1}. {art["name"]}')
-                            cols[1].markdown(f"{row.msPlayed/60000:.0f} minutos de escucha")
-
-                st.markdown('---')
-                st.markdown('## Por canciones diferentes escuchadas')
-                top_artists = data.drop('playDate', axis=1).drop_duplicates(subset=['trackName','artistName'])\
-                                .groupby(['artistName']).count().sort_values('msPlayed', ascending=False).head(10).reset_index()
-                columns = st.columns(2)
-                for idx, row in top_artists.iterrows():      
-                    with columns[idx//5]:          
-                        art = search_artist(row.artistName)
-                        with st.container():
-                            cols = st.columns([0.4,1])
-                            try:
-                                cols[0].image(art["images"][0]["url"])
-                            except IndexError:
-                                pass 
-                            except KeyError: 
-                                pass
-                            cols[1].markdown(f'#### {idx+1}. {art["name"]}')
-                            cols[1].markdown(f"{row.msPlayed:.0f} canciones distintas")
-
-                st.markdown('---')
-                st.markdown('## Géneros preferidos')
-                st.markdown('De acuerdo a tus artistas preferidos, los géneros que más escuchas son:')
-                generos = []
-                for idx, row in top_artists.iterrows():
-                    art = search_artist(row.artistName)
-                    generos.extend(art['genres'])
-                for k, v in Counter(generos).most_common(5):
-                    st.markdown(f'- {k} ({v})')
-
-            # with st.container(): # Albums
-            #     pass
-            
-            with st.container(): # Estadísticas de uso
-                st.markdown('# Estadísticas de uso (canciones)')
-
-                graph = px.histogram(data, x='playDate')
-                graph.update_traces(xbins_size=48*3600*1000)
-                # graph.update_xaxes(showgrid=True, ticklabelmode="period", dtick="M1", tickformat="%b %Y")
-                st.plotly_chart(graph)
-
-                st.markdown('# Estadísticas de uso (tiempo)')
-                
-                graph = px.histogram(data, x='playDate', y='minPlayed')
-                graph.update_traces(xbins_size=48*3600*1000)
-                # graph.update_xaxes(showgrid=True, ticklabelmode="period", dtick="D1", tickformat="%b %Y")
-                st.plotly_chart(graph)
+            # El historial se procesa una única vez por sesión mientras no cambie el fichero
+            history_hash = hashlib.blake2b(file_uploader.getvalue(), digest_size=16).hexdigest()
+            if 'history_df' not in st.session_state or st.session_state.get('history_bytes_hash') != history_hash:
+                st.session_state.history_df = load_history_cached(file_uploader, history_hash)
+                st.session_state.history_bytes_hash = history_hash
+            data = st.session_state.history_df
+
+            # Todas las métricas por artista se calculan en una única consulta
+            top_artists, n_artists, n_songs = compute_artist_stats(data)
+
+            # Se buscan de una vez todos los artistas que aparecen en algún top, 
+            # reutilizando los ya obtenidos en ejecuciones anteriores de la sesión
+            artist_cache = st.session_state.setdefault('artist_cache', {})
+            all_names = set().union(*(ranking.artistName for ranking in top_artists.values()))
+            missing_names = tuple(sorted(all_names - artist_cache.keys()))
+            if missing_names:
+                try:
+                    with st.spinner():
+                        artist_cache.update(search_artists_bulk(missing_names, SPOTIFY_API_VERSION, 
+                                                                current_cache_period(search_artists_bulk, ARTIST_TTL)))
+                except ArtistSearchError as error:
+                    st.warning('No se han podido obtener los datos de Spotify: algunos artistas se muestran sin imagen.', icon="⚠️")
+                    # Los artistas obtenidos se guardan en la caché de la sesión; los que han fallado se
+                    # muestran sin datos, sin guardarlos, para volver a buscarlos en la siguiente ejecución
+                    artist_cache.update(error.results)
+                    artist_cache = {**{name: _select_artist(name, {}) for name in error.errors}, **artist_cache}
+
+            render_metrics(data, n_artists, n_songs)
+            render_top_songs(data)
+            render_top_artists(top_artists, artist_cache)
+
+            # render_albums(data)
+
+            render_usage_stats(data)
 
         else:
             st.info('Sube el fichero de historial.', icon="ℹ️")
     else:
-        st.warning('Credenciales incorrectas.', icon="ℹ️")
+        st.warning(auth_message, icon="ℹ️")
 else:
-    st.info('Introduce tus credenciales', icon="ℹ️")
\ No newline at end of file
+    st.info('Introduce tus credenciales', icon="ℹ️")
+
+# Estadísticas de las cachés en esta sesión, para detectar llamadas redundantes a la API
+with st.sidebar.expander('Estadísticas de caché'):
+    st.json({call: dict(stats) for call, stats in sorted(get_cache_stats().items())})